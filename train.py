@@ -11,11 +11,17 @@ https://arxiv.org/abs/2006.11239
 
 '''
 
+import os
 from typing import Dict
 from tqdm import tqdm
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 from torchvision.datasets import MNIST
 import numpy as np
@@ -34,12 +40,12 @@ class ResidualConvBlock(nn.Module):
         self.conv1 = nn.Sequential(
             nn.Conv2d(in_channels, out_channels, 3, 1, 1),
             nn.BatchNorm2d(out_channels),
-            nn.GELU(),
+            nn.GELU(approximate='tanh'),
         )
         self.conv2 = nn.Sequential(
             nn.Conv2d(out_channels, out_channels, 3, 1, 1),
             nn.BatchNorm2d(out_channels),
-            nn.GELU(),
+            nn.GELU(approximate='tanh'),
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -47,12 +53,10 @@ class ResidualConvBlock(nn.Module):
             x1 = self.conv1(x)
             x2 = self.conv2(x1)
             
-            if self.same_channels:
-                # this adds on correct residual in case channels have increased
-                out = x + x2
-            else:
-                out = x1 + x2 
-            return out / 1.414
+            # this adds on correct residual in case channels have increased,
+            # scaling in place avoids allocating a second full feature map
+            res = x if self.same_channels else x1
+            return torch.add(res, x2).div_(1.414)
         else:
             x1 = self.conv1(x)
             x2 = self.conv2(x1)
@@ -100,32 +104,37 @@ class EmbedFC(nn.Module):
         self.input_dim = input_dim
         layers = [
             nn.Linear(input_dim, emb_dim),
-            nn.GELU(),
+            nn.GELU(approximate='tanh'),
             nn.Linear(emb_dim, emb_dim),
         ]
         self.model = nn.Sequential(*layers)
 
     def forward(self, x):
-        x = x.view(-1, self.input_dim)
+        # x is expected to already be of shape (batch, input_dim)
         return self.model(x)
 
 
 class Unet(nn.Module):
-    def __init__(self, in_channels, n_feat = 256):
+    def __init__(self, in_channels, n_feat = 256, n_T = 600):
         super(Unet, self).__init__()
 
         self.in_channels = in_channels
         self.n_feat = n_feat
+        self.n_T = n_T
+        self.t_scale = 1.0 / n_T # normalises the integer timestep to [0, 1]
 
         self.init_conv = ResidualConvBlock(in_channels, n_feat, is_res=True)
 
         self.down1 = UnetDown(n_feat, n_feat)
         self.down2 = UnetDown(n_feat, 2 * n_feat)
 
-        self.to_vec = nn.Sequential(nn.AvgPool2d(7), nn.GELU())
+        self.to_vec = nn.Sequential(nn.AvgPool2d(7), nn.GELU(approximate='tanh'))
 
         self.timeembed1 = EmbedFC(1, 2*n_feat)
         self.timeembed2 = EmbedFC(1, 1*n_feat)
+        # lookup tables of the time embeddings for every t in [0, n_T], filled by cache_time_embeddings
+        self.register_buffer("temb1_table", None, persistent=False)
+        self.register_buffer("temb2_table", None, persistent=False)
 
         self.up0 = nn.Sequential(
             nn.ConvTranspose2d(2 * n_feat, 2 * n_feat, 7, 7),
@@ -135,16 +144,55 @@ class Unet(nn.Module):
 
         self.up1 = UnetUp(4 * n_feat, n_feat)
         self.up2 = UnetUp(2 * n_feat, n_feat)
+        # the first output conv acts on cat(up3, x), split along its input channels
+        # so the two halves are convolved separately and summed without materialising the cat
+        self.out_a = nn.Conv2d(n_feat, n_feat, 3, 1, 1)
+        self.out_b = nn.Conv2d(n_feat, n_feat, 3, 1, 1, bias=False)
         self.out = nn.Sequential(
-            nn.Conv2d(2 * n_feat, n_feat, 3, 1, 1),
             nn.GroupNorm(8, n_feat),
             nn.ReLU(),
             nn.Conv2d(n_feat, self.in_channels, 3, 1, 1),
         )
 
+    def train(self, mode=True):
+        # the cached time embeddings go stale as soon as the weights are updated again
+        self.temb1_table = None
+        self.temb2_table = None
+        return super(Unet, self).train(mode)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        '''
+        fold the BatchNorm2d of every conv block into the preceding Conv2d, exact in eval mode.
+        The Unet is changed in place and any training wrapper around it sees the fused model too,
+        so this must only be called after the last optimizer step. Blocks that are already fused
+        are skipped, calling it again is a no-op
+        '''
+        assert not self.training, "Conv+BN folding is only exact in eval mode"
+        for block in self.modules():
+            if isinstance(block, ResidualConvBlock):
+                for name in ("conv1", "conv2"):
+                    layers = getattr(block, name)
+                    if not isinstance(layers[1], nn.BatchNorm2d):
+                        continue
+                    conv, bn, act = layers
+                    setattr(block, name, nn.Sequential(fuse_conv_bn_eval(conv, bn), act))
+        return self
+
+    @torch.no_grad()
+    def cache_time_embeddings(self):
+        '''
+        t only takes n_T+1 discrete values, so in eval mode the two embedding MLPs
+        are evaluated once for all of them and forward only has to look the rows up
+        '''
+        device = self.timeembed1.model[0].weight.device
+        all_ts = torch.arange(self.n_T + 1, device=device, dtype=torch.float32).unsqueeze(1) * self.t_scale
+        self.temb1_table = self.timeembed1(all_ts)
+        self.temb2_table = self.timeembed2(all_ts)
+
     def forward(self, x, t):
 
-        # x is a noisy image and t is timestep
+        # x is a noisy image and t is the integer timestep
         x = self.init_conv(x)
         # downsample
         down1 = self.down1(x)
@@ -152,24 +200,30 @@ class Unet(nn.Module):
         hiddenvec = self.to_vec(down2)
         
         # embedding with time step
-        temb1 = self.timeembed1(t).view(-1, self.n_feat * 2, 1, 1)
-        temb2 = self.timeembed2(t).view(-1, self.n_feat, 1, 1)
+        if self.training or self.temb1_table is None:
+            t = t.to(torch.float32).unsqueeze(1) * self.t_scale
+            temb1 = self.timeembed1(t).view(-1, self.n_feat * 2, 1, 1)
+            temb2 = self.timeembed2(t).view(-1, self.n_feat, 1, 1)
+        else:
+            temb1 = self.temb1_table.index_select(0, t).view(-1, self.n_feat * 2, 1, 1)
+            temb2 = self.temb2_table.index_select(0, t).view(-1, self.n_feat, 1, 1)
 
         # upsample
         up1 = self.up0(hiddenvec)
         up2 = self.up1(up1+ temb1, down2)
         up3 = self.up2(up2+ temb2, down1)
-        out = self.out(torch.cat((up3, x), 1))
+        out = self.out(self.out_a(up3) + self.out_b(x))
         return out
 
 
 def ddpm_schedules(beta1, beta2, T):
     """
     Returns pre-computed schedules for DDPM sampling, training process.
+    Computed in float64 to keep alphabar_t accurate for long schedules, returned in float32.
     """
     assert beta1 < beta2 < 1.0, "beta1 and beta2 must be in (0, 1)"
 
-    beta_t = (beta2 - beta1) * torch.arange(0, T + 1, dtype=torch.float32) / T + beta1
+    beta_t = (beta2 - beta1) * torch.arange(0, T + 1, dtype=torch.float64) / T + beta1
     sqrt_beta_t = torch.sqrt(beta_t)
     alpha_t = 1 - beta_t
     log_alpha_t = torch.log(alpha_t)
@@ -181,7 +235,7 @@ def ddpm_schedules(beta1, beta2, T):
     sqrtmab = torch.sqrt(1 - alphabar_t)
     mab_over_sqrtmab_inv = (1 - alpha_t) / sqrtmab
 
-    return {
+    schedules = {
         "alpha_t": alpha_t,  # \alpha_t
         "oneover_sqrta": oneover_sqrta,  # 1/\sqrt{\alpha_t}
         "sqrt_beta_t": sqrt_beta_t,  # \sqrt{\beta_t}
@@ -190,10 +244,36 @@ def ddpm_schedules(beta1, beta2, T):
         "sqrtmab": sqrtmab,  # \sqrt{1-\bar{\alpha_t}}
         "mab_over_sqrtmab": mab_over_sqrtmab_inv,  # (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}
     }
+    return {k: v.to(torch.float32) for k, v in schedules.items()}
+
+
+def diffuse(x, noise, sqrtab_t, sqrtmab_t):
+    """
+    Returns x_t = sqrt(alphabar_t) x + sqrt(1-alphabar_t) noise, fused into a single elementwise kernel
+    as part of the compiled training forward.
+    """
+    return sqrtab_t * x + sqrtmab_t * noise
+
+
+def capture_cuda_graph(step, device, n_warmup=3):
+    """
+    Warms step up on a side stream and captures it in a CUDA graph, replaying the graph reruns all of its
+    kernels without any Python dispatch. step must only read and write tensors that outlive the graph.
+    """
+    stream = torch.cuda.Stream(device)
+    stream.wait_stream(torch.cuda.current_stream(device))
+    with torch.cuda.stream(stream):
+        for _ in range(n_warmup):
+            step()
+    torch.cuda.current_stream(device).wait_stream(stream)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        step()
+    return graph
 
 
 class DDPM(nn.Module):
-    def __init__(self, nn_model, betas, n_T, device, drop_prob=0.1):
+    def __init__(self, nn_model, betas, n_T, device):
         super(DDPM, self).__init__()
         self.nn_model = nn_model.to(device)
 
@@ -204,133 +284,235 @@ class DDPM(nn.Module):
 
         self.n_T = n_T
         self.device = device
-        self.drop_prob = drop_prob
-        self.loss_mse = nn.MSELoss()
 
     def forward(self, x):
         """
         Goal: sample t and noise randomly for the process
         """
-        _ts = torch.randint(1, self.n_T+1, (x.shape[0],)).to(self.device) # t ~ U(1, n_T)
+        _ts = torch.randint(1, self.n_T+1, (x.shape[0],), device=self.device) # t ~ U(1, n_T)
         noise = torch.randn_like(x)  # eps ~ N(0, 1)
 
         # apply the model to get the predicted noise
-        x_t = (
-            self.sqrtab[_ts, None, None, None] * x
-            + self.sqrtmab[_ts, None, None, None] * noise
+        x_t = diffuse(
+            x, noise,
+            self.sqrtab.index_select(0, _ts).view(-1, 1, 1, 1),
+            self.sqrtmab.index_select(0, _ts).view(-1, 1, 1, 1),
         ) # x_t ~ N(sqrt(\bar{\alpha_t}) x_0, \sqrt{1-\bar{\alpha_t}})
         
         # return MSE between added noise, and our predicted noise
-        return self.loss_mse(noise, self.nn_model(x_t, _ts / self.n_T))
+        return F.mse_loss(noise, self.nn_model(x_t, _ts))
 
+    @torch.no_grad()
     def sample(self, n_sample, size, device):
         # sample from the model and return the generated samples and the intermediate steps for plotting
-        x_i = torch.randn(n_sample, *size).to(device)  # x_0 ~ N(0, 1)
-        x_i_store = [] # store intermediate steps for plotting
-        print()
-        for i in range(self.n_T, 0, -1):
-            print(f'sampling timestep {i}',end='\r')
-            t_is = torch.tensor([i / self.n_T]).to(device)
-            t_is = t_is.repeat(n_sample,1,1,1)
+        # store intermediate steps for plotting on the GPU, copied to the host once at the end
+        keep = [i for i in range(self.n_T, 0, -1) if i%20==0 or i==self.n_T or i<8]
+        slots = {i: k for k, i in enumerate(keep)}
+        x_i_store = torch.empty(len(keep), n_sample, *size, device=device)
+        self.nn_model.cache_time_embeddings()
+
+        # every step launches the same kernels on the same shapes, so one step is captured in a CUDA graph
+        # and replayed n_T times
+        static_x = torch.empty(n_sample, *size, device=device, memory_format=torch.channels_last)
+        static_t = torch.full((n_sample,), self.n_T, dtype=torch.long, device=device)
+        static_z = torch.zeros_like(static_x)
+
+        def step():
+            # get the predicted noise, the autocast cache has to be disabled for graph capture
+            with torch.autocast(device_type="cuda", dtype=torch.float16, cache_enabled=False):
+                eps = self.nn_model(static_x, static_t)
+            # the schedule coefficients are gathered on the GPU so that they follow static_t on replay
+            i = static_t[:1]
+            static_x.copy_(
+                self.oneover_sqrta.index_select(0, i) * (static_x - eps * self.mab_over_sqrtmab.index_select(0, i))
+                + self.sqrt_beta_t.index_select(0, i) * static_z
+            )
 
-            # double batch
-            x_i = x_i.repeat(2,1,1,1)
-            t_is = t_is.repeat(2,1,1,1)
+        graph = capture_cuda_graph(step, device)
 
-            z = torch.randn(n_sample, *size).to(device) if i > 1 else 0
-            
-            # get the predicted noise
-            eps = self.nn_model(x_i, t_is)[:n_sample]
-            x_i = x_i[:n_sample]
-            x_i = (
-                self.oneover_sqrta[i] * (x_i - eps * self.mab_over_sqrtmab[i])
-                + self.sqrt_beta_t[i] * z
-            )
-            if i%20==0 or i==self.n_T or i<8:
-                x_i_store.append(x_i.detach().cpu().numpy())
+        static_x.normal_()  # x_0 ~ N(0, 1), the warm up steps overwrote it
+        for i in range(self.n_T, 0, -1):
+            static_t.fill_(i)
+            if i > 1:
+                static_z.normal_()
+            else:
+                static_z.zero_()
+            graph.replay()
+            if i in slots:
+                x_i_store[slots[i]] = static_x
         
-        x_i_store = np.array(x_i_store)
-        return x_i, x_i_store
+        return static_x, x_i_store.cpu().numpy()
+
+    @torch.no_grad()
+    def sample_ddim(self, n_sample, size, device, stride=12):
+        # deterministic DDIM sampling visiting only every stride-th timestep, n_T/stride model calls instead of n_T
+        steps = list(range(self.n_T, 0, -stride))
+        # store intermediate steps for plotting on the GPU, copied to the host once at the end
+        x_i_store = torch.empty(len(steps), n_sample, *size, device=device)
+        self.nn_model.cache_time_embeddings()
+        # schedules at the next visited timestep, index 0 stands for the clean image with \bar{\alpha} = 1
+        sqrtab_prev = self.sqrtab.clone()
+        sqrtab_prev[0] = 1.0
+        sqrtmab_prev = self.sqrtmab.clone()
+        sqrtmab_prev[0] = 0.0
+
+        # the step is captured in a CUDA graph and replayed like in sample
+        static_x = torch.empty(n_sample, *size, device=device, memory_format=torch.channels_last)
+        static_t = torch.full((n_sample,), self.n_T, dtype=torch.long, device=device)
+        static_t_prev = torch.zeros(1, dtype=torch.long, device=device)
+
+        def step():
+            # get the predicted noise, the autocast cache has to be disabled for graph capture
+            with torch.autocast(device_type="cuda", dtype=torch.float16, cache_enabled=False):
+                eps = self.nn_model(static_x, static_t)
+            # predicted clean image, noised back to the next visited timestep
+            i = static_t[:1]
+            x_0 = (static_x - self.sqrtmab.index_select(0, i) * eps) / self.sqrtab.index_select(0, i)
+            static_x.copy_(
+                sqrtab_prev.index_select(0, static_t_prev) * x_0
+                + sqrtmab_prev.index_select(0, static_t_prev) * eps
+            )
+
+        graph = capture_cuda_graph(step, device)
+
+        static_x.normal_()  # x_T ~ N(0, 1), the warm up steps overwrote it
+        for k, i in enumerate(steps):
+            static_t.fill_(i)
+            static_t_prev.fill_(max(i - stride, 0))
+            graph.replay()
+            x_i_store[k] = static_x
+
+        return static_x, x_i_store.cpu().numpy()
 
 
 def train_mnist():
+    # one process per GPU, launched with torchrun, the process group is torn down even if training fails
+    dist.init_process_group("nccl")
+    try:
+        train_mnist_worker(dist.get_rank(), int(os.environ["LOCAL_RANK"]))
+    finally:
+        dist.destroy_process_group()
+
+
+def train_mnist_worker(rank, local_rank):
+    # rank is the global rank of the process, local_rank its GPU on the node
+    torch.cuda.set_device(local_rank)
+
+    # input shapes are fixed, so let cuDNN autotune the conv algorithms once and allow TF32 matmuls
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
 
     # training parameters
     n_epoch = 40
-    batch_size = 256
+    batch_size = 256 # per GPU
     n_T = 600 # 500
-    device = "cuda:0"
+    device = f"cuda:{local_rank}"
     n_feat = 256
     lrate = 1e-4
+    ddim_stride = 12 # sample with n_T/ddim_stride DDIM steps, None for the full DDPM chain
     save_model = True
+    log_every = 20 # steps between loss updates of the progress bar
     save_dir = './output/'
 
     # model
-    ddpm = DDPM(nn_model=Unet(in_channels=1, n_feat=n_feat), betas=(1e-4, 0.02), n_T=n_T, device=device, drop_prob=0.1)
+    unet = Unet(in_channels=1, n_feat=n_feat, n_T=n_T)
+    ddpm = DDPM(nn_model=unet, betas=(1e-4, 0.02), n_T=n_T, device=device)
     ddpm.to(device)
-
-    # dataset
+    # NHWC layout lets cuDNN pick the tensor core convolution kernels
+    unet.to(memory_format=torch.channels_last)
+    # compile the training forward so that the many small conv/norm/activation kernels get fused and replayed
+    # as CUDA graphs, ddpm itself stays eager so its state_dict keeps the plain nn_model.* keys.
+    # DDP is wrapped first so dynamo splits the graph at the gradient bucket boundaries and the
+    # all-reduce of each bucket still overlaps with the rest of the backward pass
+    model = torch.compile(DDP(ddpm, device_ids=[local_rank]), mode="reduce-overhead", fullgraph=False)
+
+    # dataset, downloaded by the first process of every node since nodes need not share a filesystem
     tf = transforms.Compose([transforms.ToTensor()]) # mnist is already normalised 0 to 1
-    dataset = MNIST("./data", train=True, download=True, transform=tf)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=5)
-    optim = torch.optim.Adam(ddpm.parameters(), lr=lrate)
+    if local_rank == 0:
+        MNIST("./data", train=True, download=True)
+    dist.barrier()
+    dataset = MNIST("./data", train=True, download=False, transform=tf)
+    sampler = DistributedSampler(dataset, shuffle=True)
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, sampler=sampler, num_workers=4, pin_memory=True,
+        persistent_workers=True, prefetch_factor=4, drop_last=True,
+    )
+    optim = torch.optim.Adam(model.parameters(), lr=lrate, fused=True)
+    # linear learning rate decay
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optim, lambda ep: 1 - ep / n_epoch)
+    # loss scaling for the mixed precision training
+    scaler = torch.cuda.amp.GradScaler()
 
     # training loop
     for ep in range(n_epoch):
-        print(f'epoch {ep}')
-        ddpm.train()
-        
-        # learning rate decay
-        optim.param_groups[0]['lr'] = lrate*(1-ep/n_epoch)
+        if rank == 0:
+            print(f'epoch {ep}')
+        model.train()
+        sampler.set_epoch(ep)
 
-        pbar = tqdm(dataloader)
+        pbar = tqdm(dataloader, mininterval=1.0, disable=rank != 0)
         loss_ema = None
-        for x, _ in pbar:
-            optim.zero_grad()
-            x = x.to(device)
-            loss = ddpm(x)
-            loss.backward()
+        for step, (x, _) in enumerate(pbar):
+            optim.zero_grad(set_to_none=True)
+            x = x.to(device, memory_format=torch.channels_last, non_blocking=True)
+            with torch.autocast(device_type="cuda", dtype=torch.float16):
+                loss = model(x)
+            scaler.scale(loss).backward()
+            # keep the running loss on the GPU, .item() syncs so only read it out every log_every steps
             if loss_ema is None:
-                loss_ema = loss.item()
+                loss_ema = loss.detach().clone()
             else:
-                loss_ema = 0.95 * loss_ema + 0.05 * loss.item()
-            pbar.set_description(f"loss: {loss_ema:.4f}")
-            optim.step()
+                loss_ema.lerp_(loss.detach(), 0.05)
+            if step % log_every == 0:
+                pbar.set_description(f"loss: {loss_ema.item():.4f}")
+            scaler.step(optim)
+            scaler.update()
+        scheduler.step()
         
-        # save images and model
-        if ep == n_epoch-1:
+        # save model and images
+        if ep == n_epoch-1 and rank == 0:
+            # save model before it gets fused for sampling
+            if save_model:
+                torch.save(ddpm.state_dict(), save_dir + f"model_{ep}.pth")
+                print('saved model at ' + save_dir + f"model_{ep}.pth")
+
             ddpm.eval()
+            unet.fuse_for_inference()
             with torch.no_grad():
                 n_sample = 10
-                x_gen, x_gen_store = ddpm.sample(n_sample, (1, 28, 28), device)
+                if ddim_stride is None:
+                    x_gen, x_gen_store = ddpm.sample(n_sample, (1, 28, 28), device)
+                else:
+                    x_gen, x_gen_store = ddpm.sample_ddim(n_sample, (1, 28, 28), device, stride=ddim_stride)
 
                 # save images and make the background black and digits white for better visibility
+                x_gen = x_gen.cpu().numpy()
                 fig, ax = plt.subplots(1, 10, figsize=(10, 1))
                 for i in range(10):
-                    ax[i].imshow(x_gen[i].cpu().numpy().reshape(28, 28), cmap='gray')
+                    ax[i].imshow(x_gen[i].reshape(28, 28), cmap='gray')
                     ax[i].axis('off')
                 plt.subplots_adjust(hspace=0.1)
                 plt.savefig(save_dir + f"image_ep{ep}.png")
                 plt.close()
                 print('saved image at ' + save_dir + f"image_ep{ep}.png")
 
+                # intermediate steps ending with the final sample, the DDIM store holds every visited step
+                # so its frames are spread evenly over the chain
+                if ddim_stride is None:
+                    frames = [4*j + 4 for j in range(7)] + [-1]
+                else:
+                    frames = np.linspace(len(x_gen_store) // 8, len(x_gen_store) - 1, 8).astype(int)
                 fig, ax = plt.subplots(1,8, figsize=(8, 1))
                 for j in range(8):
-                    if j==7:
-                        ax[j].imshow(x_gen_store[-1,0].reshape(28, 28), cmap='gray')
-                    else:
-                        ax[j].imshow(x_gen_store[4*j + 4,0].reshape(28, 28), cmap='gray')
+                    ax[j].imshow(x_gen_store[frames[j],0].reshape(28, 28), cmap='gray')
                     ax[j].axis('off')
                 plt.subplots_adjust(hspace=0.1)
                 plt.savefig(save_dir + f"image_ep{ep}_t.png")
                 plt.close()
                 print('saved image at ' + save_dir + f"image_ep{ep}_t.png")
 
-            # save model
-            if save_model:
-                torch.save(ddpm.state_dict(), save_dir + f"model_{ep}.pth")
-                print('saved model at ' + save_dir + f"model_{ep}.pth")
-
 
 if __name__ == "__main__":
     train_mnist()
\ No newline at end of file